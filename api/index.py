@@ -9,18 +9,26 @@ Escrow Shield - Group-Optimized Telegram Escrow Bot
 """
 
 import os
+import re
+import sys
+import atexit
 import time
+import asyncio
 import hmac
-import hashlib
 import base64
-import json
+import queue
 import sqlite3
 import logging
-from decimal import Decimal, InvalidOperation
+import logging.handlers
+import functools
+import zlib
+from contextlib import contextmanager
+from pathlib import Path
+from decimal import Decimal
 from typing import Optional, Tuple, Any
-from datetime import datetime, timezone
 
-import requests
+import httpx
+import orjson
 from dotenv import load_dotenv
 from telegram import (
     Update, InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardRemove, ForceReply
@@ -53,9 +61,19 @@ OKX_PASSPHRASE = os.getenv("OKX_PASSPHRASE")
 OKX_API_BASE = os.getenv("OKX_API_BASE", "https://www.okx.com").rstrip("/")
 DEPOSIT_ADDRESS = os.getenv("DEPOSIT_ADDRESS", "") or "Set_DEPOSIT_ADDRESS_IN_ENV"
 SQLITE_FILE = os.getenv("SQLITE_FILE", "escrow_bot.db")
+# Read-only connections; at least one, or the first read would block forever
+SQLITE_POOL = max(1, int(os.getenv("SQLITE_POOL") or 4))
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")  # empty -> long polling
+PORT = int(os.getenv("PORT") or 8443)
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or None  # X-Telegram-Bot-Api-Secret-Token
 
 # --- ✅ Logging Setup ---
-logging.basicConfig(level=logging.INFO)
+# Handlers only enqueue records; a listener thread does the actual stdout writes
+_LOG_QUEUE = queue.SimpleQueue()
+logging.basicConfig(level=logging.INFO, handlers=[logging.handlers.QueueHandler(_LOG_QUEUE)])
+_LOG_LISTENER = logging.handlers.QueueListener(_LOG_QUEUE, logging.StreamHandler(sys.stdout))
+_LOG_LISTENER.start()
+atexit.register(_LOG_LISTENER.stop)
 logger = logging.getLogger("escrow_bot")
 
 # Optional: Verify important environment variables are loaded
@@ -63,9 +81,51 @@ logger.info(f"BOT_TOKEN loaded: {'✅' if BOT_TOKEN else '❌'}")
 logger.info(f"ADMIN_TELEGRAM_ID: {ADMIN_TELEGRAM_ID}")
 logger.info(f"DEPOSIT_ADDRESS: {DEPOSIT_ADDRESS}")
 
+# Encoded once; signing runs on every OKX request
+_OKX_SECRET_BYTES = (OKX_API_SECRET or "").encode()
+
+# Persistent OKX client, opened and closed with the Application (see main)
+_OKX: Optional[httpx.AsyncClient] = None
+
+async def okx_client_start(app: Application):
+    """post_init hook: open the shared OKX client on the bot's event loop"""
+    global _OKX
+    # Only failed connection attempts are retried; a withdrawal POST that
+    # reached OKX must never be replayed.
+    _OKX = httpx.AsyncClient(
+        base_url=OKX_API_BASE,
+        timeout=25,
+        transport=httpx.AsyncHTTPTransport(
+            http2=True,
+            retries=2,
+            limits=httpx.Limits(max_connections=8, max_keepalive_connections=4),
+        ),
+    )
+
+async def okx_client_stop(app: Application):
+    """post_shutdown hook: close pooled OKX connections"""
+    if _OKX is not None:
+        await _OKX.aclose()
+
+def open_conn(path: str = SQLITE_FILE, readonly: bool = False):
+    """Open a tuned SQLite connection (autocommit; writers BEGIN explicitly)"""
+    if readonly:
+        # mode=ro makes SQLite itself refuse writes on reader connections
+        conn = sqlite3.connect(f"{Path(path).resolve().as_uri()}?mode=ro", uri=True, timeout=5,
+                               check_same_thread=False, isolation_level=None)
+    else:
+        conn = sqlite3.connect(path, timeout=5, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-20000")
+    conn.execute("PRAGMA mmap_size=268435456")
+    return conn
+
 def init_db(path: str = SQLITE_FILE):
     """Initialize database with improved schema for group escrows"""
-    conn = sqlite3.connect(path, check_same_thread=False)
+    conn = open_conn(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA wal_autocheckpoint=1000")
     c = conn.cursor()
     c.execute("""
     CREATE TABLE IF NOT EXISTS users (
@@ -91,12 +151,133 @@ def init_db(path: str = SQLITE_FILE):
       confirmed_at DATETIME,
       released_at DATETIME,
       okx_tx_id TEXT,
-      deposit_snapshot TEXT
+      deposit_snapshot BLOB
     )""")
-    conn.commit()
+    # escrows is only ever read by primary key and users.telegram_id is indexed
+    # through its UNIQUE constraint, so no secondary index earns its write cost.
+    # Databases created by earlier builds may still carry this one.
+    c.execute("DROP INDEX IF EXISTS idx_escrows_chat_status")
+    c.execute("ANALYZE")
     return conn
 
-DB = init_db(SQLITE_FILE)
+class ConnectionPool:
+    """One writer connection plus a fixed set of read-only reader connections.
+
+    WAL lets the readers run alongside the writer, so lookups never queue
+    behind an in-flight write. Connections are checked out for the duration
+    of a ``with`` block only and must not be held across an ``await``.
+    """
+
+    def __init__(self, path: str = SQLITE_FILE, readers: int = SQLITE_POOL):
+        self._writer = queue.SimpleQueue()
+        self._writer.put(init_db(path))
+        self._readers = queue.SimpleQueue()
+        for _ in range(readers):
+            self._readers.put(open_conn(path, readonly=True))
+
+    @contextmanager
+    def reader(self):
+        conn = self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put(conn)
+
+    @contextmanager
+    def writer(self):
+        conn = self._writer.get()
+        try:
+            yield conn
+        finally:
+            self._writer.put(conn)
+
+POOL = ConnectionPool(SQLITE_FILE)
+
+@contextmanager
+def ro_conn():
+    """Cursor on a pooled read-only connection"""
+    with POOL.reader() as conn:
+        yield conn.cursor()
+
+@contextmanager
+def rw_conn():
+    """Cursor on the writer connection, inside one BEGIN IMMEDIATE ... COMMIT block"""
+    with POOL.writer() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        cur = conn.cursor()
+        try:
+            yield cur
+            # Closing resets a partially-read UPDATE ... RETURNING so COMMIT can run
+            cur.close()
+            conn.execute("COMMIT")
+        except BaseException:
+            cur.close()
+            # A failed COMMIT leaves the transaction open; never pool it that way
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+
+def _sync_exec(statements, readonly: bool) -> list:
+    with (ro_conn() if readonly else rw_conn()) as c:
+        for sql, params in statements:
+            c.execute(sql, params)
+        return c.fetchall()
+
+async def _db_exec(sql: str, params: tuple = (), readonly: bool = False) -> list:
+    """Run one statement on a pooled connection in a worker thread; returns all rows.
+
+    Keeps disk I/O (and the fsync on commit) off the event loop thread.
+    """
+    return await asyncio.to_thread(_sync_exec, ((sql, params),), readonly)
+
+async def _db_exec_many(*statements: Tuple[str, tuple]) -> list:
+    """Run several (sql, params) writes in one transaction in a worker thread"""
+    return await asyncio.to_thread(_sync_exec, statements, False)
+
+# --- SQL statements, shared so each connection's prepared-statement cache hits ---
+_Q_USER_LANG = "SELECT lang FROM users WHERE telegram_id = ?"
+_Q_INSERT_USER = "INSERT OR IGNORE INTO users (telegram_id, username, lang) VALUES (?, ?, ?)"
+_Q_UPSERT_USER_WALLET = """
+    INSERT INTO users (telegram_id, lang, wallet) VALUES (?, ?, ?)
+    ON CONFLICT(telegram_id) DO UPDATE SET wallet = excluded.wallet
+"""
+_Q_GET_ESCROW_CORE = """
+    SELECT chat_id, buyer_id, seller_id, seller_wallet, amount, currency,
+           description, status, created_at
+    FROM escrows WHERE id = ?
+"""
+_Q_GET_PARTIES = "SELECT buyer_id, seller_id FROM escrows WHERE id = ?"
+_Q_GET_BUYER = "SELECT buyer_id FROM escrows WHERE id = ?"
+_Q_GET_VIEW = "SELECT status, buyer_id, seller_id FROM escrows WHERE id = ?"
+_Q_GET_DELIVERY = "SELECT seller_id, status, seller_wallet, amount FROM escrows WHERE id = ?"
+_Q_GET_RELEASE = "SELECT seller_wallet, amount, chat_id FROM escrows WHERE id = ?"
+_Q_INSERT_ESCROW = """
+    INSERT INTO escrows (chat_id, buyer_id, amount, description, status)
+    VALUES (?, ?, ?, ?, 'created')
+    RETURNING id
+"""
+_Q_SET_SNAPSHOT = "UPDATE escrows SET deposit_snapshot = ? WHERE id = ?"
+_Q_SET_SELLER = "UPDATE escrows SET seller_id = ?, seller_wallet = ? WHERE id = ?"
+_Q_SET_PAID = """
+    UPDATE escrows SET status = 'paid', paid_at = CURRENT_TIMESTAMP
+    WHERE id = ? AND status = 'created' AND buyer_id = ?
+    RETURNING amount
+"""
+_Q_SET_CONFIRMED = """
+    UPDATE escrows SET status = 'confirmed', confirmed_at = CURRENT_TIMESTAMP
+    WHERE id = ?
+    RETURNING chat_id
+"""
+_Q_SET_REJECTED = "UPDATE escrows SET status = 'created' WHERE id = ?"
+_Q_SET_RELEASED = """
+    UPDATE escrows SET status = 'released', okx_tx_id = ?, released_at = CURRENT_TIMESTAMP
+    WHERE id = ?
+"""
+_Q_SET_CANCELLED = """
+    UPDATE escrows SET status = 'cancelled'
+    WHERE id = ? AND status NOT IN ('released', 'cancelled') AND (buyer_id = ? OR ?)
+    RETURNING chat_id
+"""
 
 MESSAGES = {
     "welcome": {"en": "🛡️ Welcome to Escrow Shield!\n\nSecure escrow service for group transactions.\n\nUse /newescrow to start", 
@@ -133,21 +314,47 @@ MESSAGES = {
     "okx_withdraw_failed": {"en": "❌ OKX withdraw failed: {resp}", "zh": "❌ OKX 提现失败：{resp}"},
 }
 
+# Flattened view of MESSAGES with the English text filled in for every known
+# language, so get_msg is a single dict probe unless the language is unknown
+_LANGS = {lang for d in MESSAGES.values() for lang in d}
+_FLAT = {(k, lang): d.get(lang) or d["en"] for k, d in MESSAGES.items() for lang in _LANGS}
+
 def get_msg(key: str, lang: str = "en", **kwargs) -> str:
-    t = MESSAGES.get(key, {}).get(lang) or MESSAGES.get(key, {}).get("en") or ""
-    return t.format(**kwargs) if kwargs else t
+    t = _FLAT.get((key, lang))
+    if t is None:
+        t = _FLAT.get((key, "en"), "")
+    return t.format_map(kwargs) if kwargs else t
+
+# DEPOSIT_ADDRESS is fixed for the life of the process
+_PAYMENT_ADDRESS = {lang: get_msg("payment_address", lang, addr=DEPOSIT_ADDRESS) for lang in _LANGS}
+
+# Signing inputs are ASCII and fixed per endpoint, so keep them as bytes
+_GET = b"GET"
+_POST = b"POST"
+_BALANCE_PATH = "/api/v5/account/balance"
+_WITHDRAWAL_PATH = "/api/v5/asset/withdrawal"
+_BALANCE_PATH_B = _BALANCE_PATH.encode()
+_WITHDRAWAL_PATH_B = _WITHDRAWAL_PATH.encode()
+
+def okx_sign(timestamp: bytes, method: bytes, request_path: bytes, body: bytes):
+    msg = timestamp + method + request_path + body
+    return base64.b64encode(hmac.digest(_OKX_SECRET_BYTES, msg, "sha256")).decode()
 
-def okx_sign(timestamp: str, method: str, request_path: str, body: str, secret: str):
-    message = f"{timestamp}{method.upper()}{request_path}{body}"
-    mac = hmac.new(secret.encode('utf-8'), message.encode('utf-8'), digestmod=hashlib.sha256)
-    return base64.b64encode(mac.digest()).decode()
+@functools.lru_cache(maxsize=1)
+def _utc_second(sec: int) -> bytes:
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(sec)).encode()
 
-def okx_headers(method: str, request_path: str, body: Optional[dict] = None):
-    # UTC timestamp in ISO8601 format with milliseconds
-    ts = datetime.now(timezone.utc).isoformat(timespec="milliseconds").replace("+00:00", "Z")
+def okx_timestamp() -> bytes:
+    """UTC ISO8601 timestamp with milliseconds as bytes, e.g. 2020-12-08T09:08:57.715Z"""
+    sec, ms = divmod(time.time_ns() // 1_000_000, 1000)
+    return b"%s.%03dZ" % (_utc_second(sec), ms)
 
-    body_str = json.dumps(body) if body else ""
-    sig = okx_sign(ts, method, request_path, body_str, OKX_API_SECRET or "")
+def okx_headers(method: bytes, request_path: bytes, body: Optional[dict] = None):
+    ts = okx_timestamp()
+
+    # The exact bytes that are signed are the ones sent
+    body_bytes = orjson.dumps(body) if body else b""
+    sig = okx_sign(ts, method, request_path, body_bytes)
     headers = {
         "OK-ACCESS-KEY": OKX_API_KEY or "",
         "OK-ACCESS-SIGN": sig,
@@ -155,20 +362,18 @@ def okx_headers(method: str, request_path: str, body: Optional[dict] = None):
         "OK-ACCESS-PASSPHRASE": OKX_PASSPHRASE or "",
         "Content-Type": "application/json"
     }
-    return headers, body_str
+    return headers, body_bytes
 
-def okx_get_balances() -> Tuple[int, Any]:
-    path = "/api/v5/account/balance"
-    url = OKX_API_BASE + path
-    headers, _ = okx_headers("GET", path, None)
+async def okx_get_balances() -> Tuple[int, Any]:
+    headers, _ = okx_headers(_GET, _BALANCE_PATH_B, None)
     try:
-        r = requests.get(url, headers=headers, timeout=15)
-        return r.status_code, r.json()
+        r = await _OKX.get(_BALANCE_PATH, headers=headers, timeout=15)
+        return r.status_code, orjson.loads(r.content)
     except Exception as e:
         logger.error(f"OKX balance error: {e}")
         return 500, {"error": str(e)}
 
-def okx_withdraw(ccy: str, amt: str, to_addr: str = None, chain: str = "TRC20"):
+async def okx_withdraw(ccy: str, amt: str, to_addr: str = None, chain: str = "TRC20"):
     """
     Withdraw crypto via OKX API.
     Defaults to TRC20 network for USDT.
@@ -181,9 +386,6 @@ def okx_withdraw(ccy: str, amt: str, to_addr: str = None, chain: str = "TRC20"):
             logger.error("No withdrawal address provided and BOT_WALLET not set in .env")
             return 400, {"error": "Withdrawal address missing"}
 
-    path = "/api/v5/asset/withdrawal"
-    url = OKX_API_BASE + path
-
     # Ensure amount is a string (OKX API expects string)
     body = {
         "ccy": ccy,
@@ -193,11 +395,11 @@ def okx_withdraw(ccy: str, amt: str, to_addr: str = None, chain: str = "TRC20"):
         "chainName": chain    # TRC20 network
     }
 
-    headers, body_str = okx_headers("POST", path, body)
+    headers, body_bytes = okx_headers(_POST, _WITHDRAWAL_PATH_B, body)
 
     try:
-        r = requests.post(url, headers=headers, data=body_str, timeout=25)
-        response = r.json()
+        r = await _OKX.post(_WITHDRAWAL_PATH, headers=headers, content=body_bytes)
+        response = orjson.loads(r.content)
 
         if r.status_code == 200 and response.get("code") == "0":
             logger.info(f"✅ OKX withdraw successful: {response}")
@@ -210,47 +412,62 @@ def okx_withdraw(ccy: str, amt: str, to_addr: str = None, chain: str = "TRC20"):
         logger.error(f"⚠️ OKX withdraw error: {e}")
         return 500, {"error": str(e)}
 
+# TRC20 addresses: "T" + 33 Base58 characters
+_TRC20 = re.compile(r'^T[1-9A-HJ-NP-Za-km-z]{33}$')
+
+# Plain non-negative decimals only: no sign, exponent, NaN/Infinity or whitespace.
+# 18 fractional digits leaves room for OKX balance strings, not just user amounts.
+_is_plain_decimal = re.compile(r'\d{1,12}(?:\.\d{1,18})?').fullmatch
+
 def safe_decimal(s: str) -> Optional[Decimal]:
-    try:
+    if s.__class__ is str and _is_plain_decimal(s):
         return Decimal(s)
-    except (InvalidOperation, TypeError, ValueError):
-        return None
+    return None
+
+# Balance fields to try, in order, on a USDT detail entry
+_BAL_KEYS = ("availBal", "cashBal")
 
 def find_usdt_balance(parsed_json) -> Optional[Decimal]:
-    if not isinstance(parsed_json, dict):
+    # OKX v5 /account/balance shape: data[].details[].ccy; anything else is None
+    try:
+        for entry in parsed_json["data"]:
+            for d in entry["details"]:
+                if d["ccy"].upper() == "USDT":
+                    for key in _BAL_KEYS:
+                        val = safe_decimal(d.get(key))
+                        if val is not None:
+                            return val
+                    return None
+    except (KeyError, TypeError, AttributeError):
         return None
-    data = parsed_json.get("data") or []
-    if isinstance(data, list):
-        for entry in data:
-            if isinstance(entry, dict):
-                details = entry.get("details", [])
-                if isinstance(details, list):
-                    for d in details:
-                        if d.get("ccy", "").upper() == "USDT":
-                            val = d.get("availBal") or d.get("cashBal")
-                            if val:
-                                return safe_decimal(str(val))
     return None
 
-def snapshot_balances() -> Optional[dict]:
-    code, res = okx_get_balances()
+async def snapshot_balances() -> Optional[dict]:
+    code, res = await okx_get_balances()
     return res if code == 200 else None
 
+# The deposit snapshot is only an audit blob, so a reading up to `ttl` seconds old is fine
+_BAL_CACHE = {"ts": float("-inf"), "val": None}
+
+async def snapshot_balances_cached(ttl: float = 30) -> Optional[dict]:
+    if time.monotonic() - _BAL_CACHE["ts"] < ttl:
+        return _BAL_CACHE["val"]
+    val = await snapshot_balances()
+    _BAL_CACHE["ts"], _BAL_CACHE["val"] = time.monotonic(), val
+    return val
+
+# Kept synchronous: hits never touch SQLite and a miss is a single indexed read
+@functools.lru_cache(maxsize=4096)
 def get_user_lang(tg_id: int) -> str:
-    c = DB.cursor()
-    c.execute("SELECT lang FROM users WHERE telegram_id = ?", (tg_id,))
-    r = c.fetchone()
+    with ro_conn() as c:
+        c.execute(_Q_USER_LANG, (tg_id,))
+        r = c.fetchone()
     return r[0] if r else "en"
 
-def get_escrow_status_text(escrow_id: int, lang: str = "en") -> str:
+async def get_escrow_status_text(escrow_id: int, lang: str = "en") -> str:
     """Get formatted escrow status for display"""
-    c = DB.cursor()
-    c.execute("""
-        SELECT chat_id, buyer_id, seller_id, seller_wallet, amount, currency, 
-               description, status, created_at
-        FROM escrows WHERE id = ?
-    """, (escrow_id,))
-    row = c.fetchone()
+    rows = await _db_exec(_Q_GET_ESCROW_CORE, (escrow_id,), readonly=True)
+    row = rows[0] if rows else None
     
     if not row:
         return "❌ Escrow not found"
@@ -259,22 +476,89 @@ def get_escrow_status_text(escrow_id: int, lang: str = "en") -> str:
     
     status_emoji = {"created": "🆕", "paid": "💰", "confirmed": "✅", "released": "🎉", "cancelled": "❌"}.get(status, "📋")
     
-    msg = f"{status_emoji} <b>Escrow #{escrow_id}</b>\n"
-    msg += f"━━━━━━━━━━━━━━━━━━\n"
-    msg += f"💵 Amount: <b>{amount} {currency}</b>\n"
-    msg += f"👤 Buyer: <a href='tg://user?id={buyer_id}'>User {buyer_id}</a>\n"
-    
-    if seller_id:
-        msg += f"🧑‍💼 Seller: <a href='tg://user?id={seller_id}'>User {seller_id}</a>\n"
-    else:
-        msg += f"🧑‍💼 Seller: <i>Not set</i>\n"
+    parts = [
+        f"{status_emoji} <b>Escrow #{escrow_id}</b>\n",
+        "━━━━━━━━━━━━━━━━━━\n",
+        f"💵 Amount: <b>{amount} {currency}</b>\n",
+        f"👤 Buyer: <a href='tg://user?id={buyer_id}'>User {buyer_id}</a>\n",
+        f"🧑‍💼 Seller: <a href='tg://user?id={seller_id}'>User {seller_id}</a>\n" if seller_id
+        else "🧑‍💼 Seller: <i>Not set</i>\n",
+    ]
     
     if description:
-        msg += f"📝 {description}\n"
+        parts.append(f"📝 {description}\n")
     
-    msg += f"📊 Status: <b>{status.upper()}</b>\n"
+    parts.append(f"📊 Status: <b>{status.upper()}</b>\n")
     
-    return msg
+    return "".join(parts)
+
+# Inline keyboards are frozen once built, so one instance per escrow can be shared
+@functools.lru_cache(maxsize=2048)
+def _kb_view(escrow_id: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("📋 View Details / 查看详情", callback_data=f"view_{escrow_id}")]
+    ])
+
+@functools.lru_cache(maxsize=2048)
+def _kb_escrow_created(escrow_id: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("🧑‍💼 I'm the Seller / 我是卖家", callback_data=f"setseller_{escrow_id}")],
+        [InlineKeyboardButton("📋 View Details / 查看详情", callback_data=f"view_{escrow_id}")]
+    ])
+
+@functools.lru_cache(maxsize=2048)
+def _kb_wallet_saved(escrow_id: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("💳 View Payment Address / 查看付款地址", callback_data=f"payaddr_{escrow_id}")],
+        [InlineKeyboardButton("📋 View Details / 查看详情", callback_data=f"view_{escrow_id}")]
+    ])
+
+@functools.lru_cache(maxsize=2048)
+def _kb_payaddr(escrow_id: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("✅ Mark as Paid / 标记已付", callback_data=f"markpaid_{escrow_id}")],
+        [InlineKeyboardButton("🔙 Back / 返回", callback_data=f"view_{escrow_id}")]
+    ])
+
+@functools.lru_cache(maxsize=2048)
+def _kb_admin_confirm(escrow_id: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("✅ Confirm Payment", callback_data=f"admin_confirm_{escrow_id}")],
+        [InlineKeyboardButton("❌ Reject", callback_data=f"admin_reject_{escrow_id}")]
+    ])
+
+@functools.lru_cache(maxsize=2048)
+def _kb_delivery(escrow_id: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("📦 Confirm Delivery / 确认交付", callback_data=f"delivered_{escrow_id}")],
+        [InlineKeyboardButton("📋 View / 查看", callback_data=f"view_{escrow_id}")]
+    ])
+
+@functools.lru_cache(maxsize=2048)
+def _kb_admin_release(escrow_id: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("💸 Release Funds", callback_data=f"admin_release_{escrow_id}")]
+    ])
+
+@functools.lru_cache(maxsize=2048)
+def _kb_escrow_view(escrow_id: int, can_pay: bool, can_deliver: bool, can_cancel: bool) -> InlineKeyboardMarkup:
+    keyboard = []
+    if can_pay:
+        keyboard.append([InlineKeyboardButton("💳 Payment Address / 付款地址", callback_data=f"payaddr_{escrow_id}")])
+        keyboard.append([InlineKeyboardButton("✅ Mark Paid / 标记已付", callback_data=f"markpaid_{escrow_id}")])
+    elif can_deliver:
+        keyboard.append([InlineKeyboardButton("📦 Confirm Delivery / 确认交付", callback_data=f"delivered_{escrow_id}")])
+    keyboard.append([InlineKeyboardButton("🔄 Refresh / 刷新", callback_data=f"view_{escrow_id}")])
+    if can_cancel:
+        keyboard.append([InlineKeyboardButton("❌ Cancel / 取消", callback_data=f"cancel_{escrow_id}")])
+    return InlineKeyboardMarkup(keyboard)
+
+async def _store_deposit_snapshot(escrow_id: int):
+    """Attach the OKX balance snapshot to an escrow once it arrives"""
+    snapshot = await snapshot_balances_cached()
+    if snapshot:
+        # Audit-only; stored as zlib-compressed JSON to keep escrow rows small
+        await _db_exec(_Q_SET_SNAPSHOT, (zlib.compress(orjson.dumps(snapshot), 1), escrow_id))
 
 async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /start command"""
@@ -292,10 +576,8 @@ async def newescrow_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     buyer_username = update.message.from_user.username or f"User{buyer_id}"
     lang = get_user_lang(buyer_id)
     
-    c = DB.cursor()
-    c.execute("INSERT OR IGNORE INTO users (telegram_id, username, lang) VALUES (?, ?, ?)", 
-              (buyer_id, buyer_username, lang))
-    DB.commit()
+    await _db_exec(_Q_INSERT_USER, (buyer_id, buyer_username, lang))
+    # No cache invalidation needed: the row is stored with the lang we just cached
     
     context.user_data['creating_escrow'] = {
         'buyer_id': buyer_id,
@@ -320,28 +602,21 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         seller_id = context.user_data['setting_wallet']['seller_id']
         wallet = text
         
-        if len(wallet) < 20 or len(wallet) > 50:
+        if not _TRC20.match(wallet):
             await update.message.reply_text("❌ Invalid wallet format. Try again.")
             return
         
-        c = DB.cursor()
-        c.execute("UPDATE escrows SET seller_id = ?, seller_wallet = ? WHERE id = ?", 
-                  (seller_id, wallet, escrow_id))
-        c.execute("UPDATE users SET wallet = ? WHERE telegram_id = ?", 
-                  (wallet, seller_id))
-        DB.commit()
+        await _db_exec_many(
+            (_Q_SET_SELLER, (seller_id, wallet, escrow_id)),
+            (_Q_UPSERT_USER_WALLET, (seller_id, lang, wallet)),
+        )
         
         del context.user_data['setting_wallet']
         
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton("💳 View Payment Address / 查看付款地址", callback_data=f"payaddr_{escrow_id}")],
-            [InlineKeyboardButton("📋 View Details / 查看详情", callback_data=f"view_{escrow_id}")]
-        ])
-        
         await update.message.reply_text(
             get_msg("wallet_saved", lang),
             parse_mode='HTML',
-            reply_markup=keyboard
+            reply_markup=_kb_wallet_saved(escrow_id)
         )
         return
     
@@ -365,350 +640,313 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         elif step == 'description':
             description = text[:200]
-            snapshot = snapshot_balances()
             
-            c = DB.cursor()
-            c.execute("""
-                INSERT INTO escrows (chat_id, buyer_id, amount, description, status, deposit_snapshot)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, (
+            rows = await _db_exec(_Q_INSERT_ESCROW, (
                 escrow_data['chat_id'],
                 escrow_data['buyer_id'],
                 escrow_data['amount'],
-                description,
-                'created',
-                json.dumps(snapshot) if snapshot else None
+                description
             ))
-            DB.commit()
+            escrow_id = rows[0][0]
+            
+            # The OKX round-trip must not delay the reply. Application.stop() awaits
+            # the task, so it finishes before post_shutdown closes the OKX client.
+            context.application.create_task(_store_deposit_snapshot(escrow_id), update=update)
             
-            escrow_id = c.lastrowid
             del context.user_data['creating_escrow']
             
-            keyboard = InlineKeyboardMarkup([
-                [InlineKeyboardButton("🧑‍💼 I'm the Seller / 我是卖家", callback_data=f"setseller_{escrow_id}")],
-                [InlineKeyboardButton("📋 View Details / 查看详情", callback_data=f"view_{escrow_id}")]
-            ])
+            if ADMIN_TELEGRAM_ID:
+                context.application.create_task(context.bot.send_message(
+                    ADMIN_TELEGRAM_ID,
+                    f"🆕 New escrow #{escrow_id}\n"
+                    f"Amount: {escrow_data['amount']} USDT\n"
+                    f"Description: {description}"
+                ), update=update)
             
             await update.message.reply_text(
                 get_msg("escrow_created", lang, id=escrow_id, amt=escrow_data['amount'], desc=description),
                 parse_mode='HTML',
-                reply_markup=keyboard
+                reply_markup=_kb_escrow_created(escrow_id)
             )
-            
-            if ADMIN_TELEGRAM_ID:
-                try:
-                    await context.bot.send_message(
-                        ADMIN_TELEGRAM_ID,
-                        f"🆕 New escrow #{escrow_id}\n"
-                        f"Amount: {escrow_data['amount']} USDT\n"
-                        f"Description: {description}"
-                    )
-                except Exception as e:
-                    logger.error(f"Failed to notify admin: {e}")
 
-async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle all inline button callbacks"""
+async def _cb_setseller(update: Update, context: ContextTypes.DEFAULT_TYPE, escrow_id: int, lang: str):
+    """Seller claims the escrow and is asked for a wallet"""
     q = update.callback_query
-    await q.answer()
+    user_id = q.from_user.id
+    
+    rows = await _db_exec(_Q_GET_PARTIES, (escrow_id,), readonly=True)
+    row = rows[0] if rows else None
+    
+    if not row:
+        await q.edit_message_text("❌ Escrow not found.")
+        return
+    
+    buyer_id, seller_id = row
+    
+    if user_id == buyer_id:
+        await q.answer(get_msg("only_seller", lang), show_alert=True)
+        return
+    
+    if seller_id:
+        await q.answer("⚠️ Seller already set!", show_alert=True)
+        return
     
-    data = q.data
+    context.user_data['setting_wallet'] = {
+        'escrow_id': escrow_id,
+        'seller_id': user_id
+    }
+    
+    await q.message.reply_text(
+        get_msg("seller_prompt", lang), 
+        parse_mode='HTML',
+        reply_markup=ForceReply(selective=True)
+    )
+    await q.edit_message_text("✅ Seller registration started. Please reply to the next message with your wallet address.")
+
+async def _cb_view(update: Update, context: ContextTypes.DEFAULT_TYPE, escrow_id: int, lang: str):
+    """Show escrow details with the buttons available to this user"""
+    q = update.callback_query
     user_id = q.from_user.id
-    lang = get_user_lang(user_id)
     
-    if data.startswith("setseller_"):
-        escrow_id = int(data.split("_")[1])
-        
-        c = DB.cursor()
-        c.execute("SELECT buyer_id, seller_id FROM escrows WHERE id = ?", (escrow_id,))
-        row = c.fetchone()
-        
-        if not row:
-            await q.edit_message_text("❌ Escrow not found.")
-            return
-        
-        buyer_id, seller_id = row
-        
-        if user_id == buyer_id:
-            await q.answer(get_msg("only_seller", lang), show_alert=True)
-            return
-        
-        if seller_id:
-            await q.answer("⚠️ Seller already set!", show_alert=True)
-            return
-        
-        context.user_data['setting_wallet'] = {
-            'escrow_id': escrow_id,
-            'seller_id': user_id
-        }
-        
-        await q.message.reply_text(
-            get_msg("seller_prompt", lang), 
-            parse_mode='HTML',
-            reply_markup=ForceReply(selective=True)
-        )
-        await q.edit_message_text("✅ Seller registration started. Please reply to the next message with your wallet address.")
+    msg = await get_escrow_status_text(escrow_id, lang)
     
-    elif data.startswith("view_"):
-        escrow_id = int(data.split("_")[1])
-        msg = get_escrow_status_text(escrow_id, lang)
-        
-        c = DB.cursor()
-        c.execute("SELECT status, buyer_id, seller_id FROM escrows WHERE id = ?", (escrow_id,))
-        row = c.fetchone()
-        
-        if row:
-            status, buyer_id, seller_id = row
-            keyboard = []
-            
-            if status == "created" and seller_id and user_id == buyer_id:
-                keyboard.append([InlineKeyboardButton("💳 Payment Address / 付款地址", callback_data=f"payaddr_{escrow_id}")])
-                keyboard.append([InlineKeyboardButton("✅ Mark Paid / 标记已付", callback_data=f"markpaid_{escrow_id}")])
-            
-            elif status == "confirmed" and user_id == seller_id:
-                keyboard.append([InlineKeyboardButton("📦 Confirm Delivery / 确认交付", callback_data=f"delivered_{escrow_id}")])
-            
-            keyboard.append([InlineKeyboardButton("🔄 Refresh / 刷新", callback_data=f"view_{escrow_id}")])
-            
-            if user_id in [buyer_id, ADMIN_TELEGRAM_ID]:
-                keyboard.append([InlineKeyboardButton("❌ Cancel / 取消", callback_data=f"cancel_{escrow_id}")])
-            
-            await q.edit_message_text(
-                msg,
-                parse_mode='HTML',
-                reply_markup=InlineKeyboardMarkup(keyboard) if keyboard else None
-            )
-        else:
-            await q.edit_message_text(msg, parse_mode='HTML')
+    rows = await _db_exec(_Q_GET_VIEW, (escrow_id,), readonly=True)
+    row = rows[0] if rows else None
+    
+    if row:
+        status, buyer_id, seller_id = row
     
-    elif data.startswith("payaddr_"):
-        escrow_id = int(data.split("_")[1])
-        
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton("✅ Mark as Paid / 标记已付", callback_data=f"markpaid_{escrow_id}")],
-            [InlineKeyboardButton("🔙 Back / 返回", callback_data=f"view_{escrow_id}")]
-        ])
-        
         await q.edit_message_text(
-            get_msg("payment_address", lang, addr=DEPOSIT_ADDRESS),
+            msg,
             parse_mode='HTML',
-            reply_markup=keyboard
+            reply_markup=_kb_escrow_view(
+                escrow_id,
+                bool(status == "created" and seller_id and user_id == buyer_id),
+                status == "confirmed" and user_id == seller_id,
+                user_id in (buyer_id, ADMIN_TELEGRAM_ID),
+            )
         )
+    else:
+        await q.edit_message_text(msg, parse_mode='HTML')
+
+async def _cb_payaddr(update: Update, context: ContextTypes.DEFAULT_TYPE, escrow_id: int, lang: str):
+    """Show the deposit address"""
+    q = update.callback_query
+    await q.edit_message_text(
+        _PAYMENT_ADDRESS.get(lang) or _PAYMENT_ADDRESS["en"],
+        parse_mode='HTML',
+        reply_markup=_kb_payaddr(escrow_id)
+    )
+
+async def _cb_markpaid(update: Update, context: ContextTypes.DEFAULT_TYPE, escrow_id: int, lang: str):
+    """Buyer marks the escrow as paid and the admin is notified"""
+    q = update.callback_query
+    user_id = q.from_user.id
     
-    elif data.startswith("markpaid_"):
-        escrow_id = int(data.split("_")[1])
-        
-        c = DB.cursor()
-        c.execute("SELECT buyer_id, status, amount FROM escrows WHERE id = ?", (escrow_id,))
-        row = c.fetchone()
-        
+    # Check and mutate in one statement; only the rejection path needs a second look
+    rows = await _db_exec(_Q_SET_PAID, (escrow_id, user_id))
+    row = rows[0] if rows else None
+    
+    if not row:
+        rows = await _db_exec(_Q_GET_BUYER, (escrow_id,), readonly=True)
+        row = rows[0] if rows else None
         if not row:
             await q.edit_message_text("❌ Escrow not found.")
-            return
-        
-        buyer_id, status, amount = row
-        
-        if user_id != buyer_id:
+        elif user_id != row[0]:
             await q.answer(get_msg("only_buyer", lang), show_alert=True)
-            return
-        
-        if status != "created":
+        else:
             await q.answer("⚠️ Already marked!", show_alert=True)
-            return
-        
-        c.execute("UPDATE escrows SET status = ?, paid_at = CURRENT_TIMESTAMP WHERE id = ?", 
-                  ("paid", escrow_id))
-        DB.commit()
-        
-        await q.edit_message_text(get_msg("paid_marked", lang), parse_mode='HTML')
-        
-        if ADMIN_TELEGRAM_ID:
-            keyboard = InlineKeyboardMarkup([
-                [InlineKeyboardButton("✅ Confirm Payment", callback_data=f"admin_confirm_{escrow_id}")],
-                [InlineKeyboardButton("❌ Reject", callback_data=f"admin_reject_{escrow_id}")]
-            ])
-            
-            try:
-                await context.bot.send_message(
-                    ADMIN_TELEGRAM_ID,
-                    f"💰 Escrow #{escrow_id} marked PAID\n"
-                    f"Amount: {amount} USDT\n\n"
-                    f"Please verify and confirm.",
-                    reply_markup=keyboard
-                )
-            except Exception as e:
-                logger.error(f"Failed to notify admin: {e}")
-    
-    elif data.startswith("admin_confirm_"):
-        if user_id != ADMIN_TELEGRAM_ID:
-            await q.answer(get_msg("only_admin", lang), show_alert=True)
-            return
-        
-        escrow_id = int(data.split("_")[2])
-        
-        c = DB.cursor()
-        c.execute("UPDATE escrows SET status = ?, confirmed_at = CURRENT_TIMESTAMP WHERE id = ?", 
-                  ("confirmed", escrow_id))
-        c.execute("SELECT chat_id FROM escrows WHERE id = ?", (escrow_id,))
-        row = c.fetchone()
-        DB.commit()
-        
-        await q.edit_message_text(f"{get_msg('confirmed', lang)}\n\nEscrow #{escrow_id}")
-        
-        if row:
-            chat_id = row[0]
-            keyboard = InlineKeyboardMarkup([
-                [InlineKeyboardButton("📦 Confirm Delivery / 确认交付", callback_data=f"delivered_{escrow_id}")],
-                [InlineKeyboardButton("📋 View / 查看", callback_data=f"view_{escrow_id}")]
-            ])
-            
-            try:
-                await context.bot.send_message(
-                    chat_id,
-                    f"{get_msg('confirmed', 'en')} / {get_msg('confirmed', 'zh')}\n\n"
-                    f"Escrow #{escrow_id}\n\n"
-                    f"{get_msg('seller_deliver', 'en')}\n{get_msg('seller_deliver', 'zh')}",
-                    reply_markup=keyboard
-                )
-            except Exception as e:
-                logger.error(f"Failed to send to group: {e}")
-    
-    elif data.startswith("admin_reject_"):
-        if user_id != ADMIN_TELEGRAM_ID:
-            await q.answer(get_msg("only_admin", lang), show_alert=True)
-            return
-        
-        escrow_id = int(data.split("_")[2])
-        
-        c = DB.cursor()
-        c.execute("UPDATE escrows SET status = ? WHERE id = ?", ("created", escrow_id))
-        DB.commit()
-        
-        await q.edit_message_text(f"❌ Payment rejected for escrow #{escrow_id}")
+        return
     
-    elif data.startswith("delivered_"):
-        escrow_id = int(data.split("_")[1])
-        
-        c = DB.cursor()
-        c.execute("SELECT seller_id, status, seller_wallet, amount FROM escrows WHERE id = ?", (escrow_id,))
-        row = c.fetchone()
-        
-        if not row:
-            await q.edit_message_text("❌ Escrow not found.")
-            return
-        
-        seller_id, status, seller_wallet, amount = row
-        
-        if user_id != seller_id:
-            await q.answer(get_msg("only_seller", lang), show_alert=True)
-            return
-        
-        if status != "confirmed":
-            await q.answer("⚠️ Not confirmed yet!", show_alert=True)
-            return
-        
-        await q.edit_message_text(get_msg("delivered", lang), parse_mode='HTML')
-        
-        if ADMIN_TELEGRAM_ID:
-            keyboard = InlineKeyboardMarkup([
-                [InlineKeyboardButton("💸 Release Funds", callback_data=f"admin_release_{escrow_id}")]
-            ])
-            
-            try:
-                await context.bot.send_message(
-                    ADMIN_TELEGRAM_ID,
-                    f"📦 Delivery confirmed for escrow #{escrow_id}\n\n"
-                    f"Amount: {amount} USDT\n"
-                    f"Wallet: {seller_wallet}\n\n"
-                    f"Ready to release?",
-                    reply_markup=keyboard
-                )
-            except Exception as e:
-                logger.error(f"Failed to notify admin: {e}")
-    
-    elif data.startswith("admin_release_"):
-        if user_id != ADMIN_TELEGRAM_ID:
-            await q.answer(get_msg("only_admin", lang), show_alert=True)
-            return
-        
-        escrow_id = int(data.split("_")[2])
-        
-        c = DB.cursor()
-        c.execute("SELECT seller_wallet, amount, chat_id FROM escrows WHERE id = ?", (escrow_id,))
-        row = c.fetchone()
-        
-        if not row:
-            await q.edit_message_text("❌ Escrow not found.")
-            return
-        
-        seller_wallet, amount, chat_id = row
-        
-        if not seller_wallet:
-            await q.edit_message_text("❌ No seller wallet!")
-            return
-        
-        await q.edit_message_text("⏳ Processing withdrawal...")
-        
-        code, res = okx_withdraw("USDT", amount, seller_wallet, chain="TRC20")
-        
-        if code == 200 and res.get("code") in (None, "0"):
-            txid = None
-            data_field = res.get("data")
-            if isinstance(data_field, list) and data_field:
-                txid = data_field[0].get("wdId")
-            
-            c.execute("UPDATE escrows SET status = ?, okx_tx_id = ?, released_at = CURRENT_TIMESTAMP WHERE id = ?", 
-                      ("released", txid or "manual", escrow_id))
-            DB.commit()
-            
-            await q.edit_message_text(
-                f"{get_msg('released', 'en')}\n\n"
-                f"Escrow #{escrow_id}\n"
-                f"TX: {txid or 'manual'}"
-            )
-            
-            try:
-                await context.bot.send_message(
-                    chat_id,
-                    f"{get_msg('released', 'en')} / {get_msg('released', 'zh')}\n\n"
-                    f"Escrow #{escrow_id}\n"
-                    f"TX ID: <code>{txid or 'manual'}</code>",
-                    parse_mode='HTML'
-                )
-            except Exception as e:
-                logger.error(f"Failed to send to group: {e}")
-        else:
-            await q.edit_message_text(get_msg("okx_withdraw_failed", lang, resp=str(res)))
+    amount = row[0]
     
-    elif data.startswith("cancel_"):
-        escrow_id = int(data.split("_")[1])
-        
-        c = DB.cursor()
-        c.execute("SELECT buyer_id, status, chat_id FROM escrows WHERE id = ?", (escrow_id,))
-        row = c.fetchone()
-        
+    if ADMIN_TELEGRAM_ID:
+        context.application.create_task(context.bot.send_message(
+            ADMIN_TELEGRAM_ID,
+            f"💰 Escrow #{escrow_id} marked PAID\n"
+            f"Amount: {amount} USDT\n\n"
+            f"Please verify and confirm.",
+            reply_markup=_kb_admin_confirm(escrow_id)
+        ), update=update)
+    
+    await q.edit_message_text(get_msg("paid_marked", lang), parse_mode='HTML')
+
+async def _cb_admin_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE, escrow_id: int, lang: str):
+    """Admin confirms the payment and the group is notified"""
+    q = update.callback_query
+    user_id = q.from_user.id
+    
+    if user_id != ADMIN_TELEGRAM_ID:
+        await q.answer(get_msg("only_admin", lang), show_alert=True)
+        return
+    
+    rows = await _db_exec(_Q_SET_CONFIRMED, (escrow_id,))
+    row = rows[0] if rows else None
+    
+    if row:
+        context.application.create_task(context.bot.send_message(
+            row[0],
+            f"{get_msg('confirmed', 'en')} / {get_msg('confirmed', 'zh')}\n\n"
+            f"Escrow #{escrow_id}\n\n"
+            f"{get_msg('seller_deliver', 'en')}\n{get_msg('seller_deliver', 'zh')}",
+            reply_markup=_kb_delivery(escrow_id)
+        ), update=update)
+    
+    await q.edit_message_text(f"{get_msg('confirmed', lang)}\n\nEscrow #{escrow_id}")
+
+async def _cb_admin_reject(update: Update, context: ContextTypes.DEFAULT_TYPE, escrow_id: int, lang: str):
+    """Admin rejects the payment and the escrow goes back to created"""
+    q = update.callback_query
+    user_id = q.from_user.id
+    
+    if user_id != ADMIN_TELEGRAM_ID:
+        await q.answer(get_msg("only_admin", lang), show_alert=True)
+        return
+    
+    await _db_exec(_Q_SET_REJECTED, (escrow_id,))
+    
+    await q.edit_message_text(f"❌ Payment rejected for escrow #{escrow_id}")
+
+async def _cb_delivered(update: Update, context: ContextTypes.DEFAULT_TYPE, escrow_id: int, lang: str):
+    """Seller confirms delivery and the admin is asked to release"""
+    q = update.callback_query
+    user_id = q.from_user.id
+    
+    rows = await _db_exec(_Q_GET_DELIVERY, (escrow_id,), readonly=True)
+    row = rows[0] if rows else None
+    
+    if not row:
+        await q.edit_message_text("❌ Escrow not found.")
+        return
+    
+    seller_id, status, seller_wallet, amount = row
+    
+    if user_id != seller_id:
+        await q.answer(get_msg("only_seller", lang), show_alert=True)
+        return
+    
+    if status != "confirmed":
+        await q.answer("⚠️ Not confirmed yet!", show_alert=True)
+        return
+    
+    if ADMIN_TELEGRAM_ID:
+        context.application.create_task(context.bot.send_message(
+            ADMIN_TELEGRAM_ID,
+            f"📦 Delivery confirmed for escrow #{escrow_id}\n\n"
+            f"Amount: {amount} USDT\n"
+            f"Wallet: {seller_wallet}\n\n"
+            f"Ready to release?",
+            reply_markup=_kb_admin_release(escrow_id)
+        ), update=update)
+    
+    await q.edit_message_text(get_msg("delivered", lang), parse_mode='HTML')
+
+async def _cb_admin_release(update: Update, context: ContextTypes.DEFAULT_TYPE, escrow_id: int, lang: str):
+    """Admin releases funds to the seller via OKX"""
+    q = update.callback_query
+    user_id = q.from_user.id
+    
+    if user_id != ADMIN_TELEGRAM_ID:
+        await q.answer(get_msg("only_admin", lang), show_alert=True)
+        return
+    
+    rows = await _db_exec(_Q_GET_RELEASE, (escrow_id,), readonly=True)
+    row = rows[0] if rows else None
+    
+    if not row:
+        await q.edit_message_text("❌ Escrow not found.")
+        return
+    
+    seller_wallet, amount, chat_id = row
+    
+    if not seller_wallet:
+        await q.edit_message_text("❌ No seller wallet!")
+        return
+    
+    await q.edit_message_text("⏳ Processing withdrawal...")
+    
+    code, res = await okx_withdraw("USDT", amount, seller_wallet, chain="TRC20")
+    
+    if code == 200 and res.get("code") in (None, "0"):
+        txid = None
+        data_field = res.get("data")
+        if isinstance(data_field, list) and data_field:
+            txid = data_field[0].get("wdId")
+    
+        await _db_exec(_Q_SET_RELEASED, (txid or "manual", escrow_id))
+    
+        context.application.create_task(context.bot.send_message(
+            chat_id,
+            f"{get_msg('released', 'en')} / {get_msg('released', 'zh')}\n\n"
+            f"Escrow #{escrow_id}\n"
+            f"TX ID: <code>{txid or 'manual'}</code>",
+            parse_mode='HTML'
+        ), update=update)
+    
+        await q.edit_message_text(
+            f"{get_msg('released', 'en')}\n\n"
+            f"Escrow #{escrow_id}\n"
+            f"TX: {txid or 'manual'}"
+        )
+    else:
+        await q.edit_message_text(get_msg("okx_withdraw_failed", lang, resp=str(res)))
+
+async def _cb_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE, escrow_id: int, lang: str):
+    """Buyer or admin cancels the escrow"""
+    q = update.callback_query
+    user_id = q.from_user.id
+    
+    rows = await _db_exec(_Q_SET_CANCELLED, (escrow_id, user_id, user_id == ADMIN_TELEGRAM_ID))
+    row = rows[0] if rows else None
+    
+    if not row:
+        rows = await _db_exec(_Q_GET_BUYER, (escrow_id,), readonly=True)
+        row = rows[0] if rows else None
         if not row:
             await q.edit_message_text("❌ Escrow not found.")
-            return
-        
-        buyer_id, status, chat_id = row
-        
-        if user_id not in [buyer_id, ADMIN_TELEGRAM_ID]:
+        elif user_id not in [row[0], ADMIN_TELEGRAM_ID]:
             await q.answer(get_msg("only_admin", lang), show_alert=True)
-            return
-        
-        if status in ("released", "cancelled"):
+        else:
             await q.answer("⚠️ Cannot cancel!", show_alert=True)
-            return
-        
-        c.execute("UPDATE escrows SET status = ? WHERE id = ?", ("cancelled", escrow_id))
-        DB.commit()
-        
-        await q.edit_message_text(get_msg("cancelled", lang))
-        
-        try:
-            await context.bot.send_message(chat_id, get_msg("cancelled", "en") + " / " + get_msg("cancelled", "zh") + f"\n\nEscrow #{escrow_id}")
-        except Exception as e:
-            logger.error(f"Failed to send cancellation: {e}")
+        return
+    
+    chat_id = row[0]
+    
+    context.application.create_task(context.bot.send_message(
+        chat_id,
+        get_msg("cancelled", "en") + " / " + get_msg("cancelled", "zh") + f"\n\nEscrow #{escrow_id}"
+    ), update=update)
+    
+    await q.edit_message_text(get_msg("cancelled", lang))
+
+_CB_TABLE = {
+    "setseller": _cb_setseller,
+    "view": _cb_view,
+    "payaddr": _cb_payaddr,
+    "markpaid": _cb_markpaid,
+    "admin_confirm": _cb_admin_confirm,
+    "admin_reject": _cb_admin_reject,
+    "delivered": _cb_delivered,
+    "admin_release": _cb_admin_release,
+    "cancel": _cb_cancel,
+}
+
+# callback_data is "<action>_<escrow_id>"; only known actions reach callback_handler
+_CB_PATTERN = re.compile(rf"({'|'.join(_CB_TABLE)})_([0-9]+)\Z")
+
+async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle inline button callbacks matching _CB_PATTERN"""
+    q = update.callback_query
+    await q.answer()
+    
+    action, escrow_id = context.match.groups()
+    
+    lang = get_user_lang(q.from_user.id)
+    await _CB_TABLE[action](update, context, int(escrow_id), lang)
+
+async def stale_callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Acknowledge buttons no action matches, so the client stops spinning"""
+    await update.callback_query.answer()
 
 async def escrow_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """View escrow details"""
@@ -723,13 +961,9 @@ async def escrow_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     lang = get_user_lang(update.effective_user.id)
-    msg = get_escrow_status_text(escrow_id, lang)
-    
-    keyboard = InlineKeyboardMarkup([
-        [InlineKeyboardButton("📋 View Details / 查看详情", callback_data=f"view_{escrow_id}")]
-    ])
+    msg = await get_escrow_status_text(escrow_id, lang)
     
-    await update.message.reply_text(msg, parse_mode='HTML', reply_markup=keyboard)
+    await update.message.reply_text(msg, parse_mode='HTML', reply_markup=_kb_view(escrow_id))
 
 async def balance_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Check OKX balance (admin only)"""
@@ -737,7 +971,7 @@ async def balance_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(get_msg("only_admin", get_user_lang(update.effective_user.id)))
         return
     
-    code, res = okx_get_balances()
+    code, res = await okx_get_balances()
     
     if code == 200:
         usdt_balance = find_usdt_balance(res)
@@ -745,7 +979,7 @@ async def balance_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if usdt_balance:
             msg += f"USDT: <b>{usdt_balance}</b>"
         else:
-            msg += f"<code>{json.dumps(res, indent=2)[:500]}</code>"
+            msg += f"<code>{orjson.dumps(res, option=orjson.OPT_INDENT_2).decode()[:500]}</code>"
         await update.message.reply_text(msg, parse_mode='HTML')
     else:
         await update.message.reply_text(f"❌ Failed: {res}")
@@ -758,19 +992,41 @@ def main():
     
     logger.info("Starting Escrow Shield Bot...")
     
-    app = Application.builder().token(BOT_TOKEN).build()
+    app = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .post_init(okx_client_start)
+        .post_shutdown(okx_client_stop)
+        .build()
+    )
     
     app.add_handler(CommandHandler("start", start_cmd))
     app.add_handler(CommandHandler("newescrow", newescrow_cmd))
     app.add_handler(CommandHandler("escrow", escrow_cmd))
     app.add_handler(CommandHandler("balance", balance_cmd))
     
-    app.add_handler(CallbackQueryHandler(callback_handler))
+    app.add_handler(CallbackQueryHandler(callback_handler, pattern=_CB_PATTERN))
+    app.add_handler(CallbackQueryHandler(stale_callback_handler))
     
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, text_handler))
     
     logger.info("Bot running! Press Ctrl+C to stop.")
-    app.run_polling(allowed_updates=Update.ALL_TYPES)
+    if WEBHOOK_URL:
+        # PTB's own webhook server feeds updates on the handlers' event loop
+        app.run_webhook(
+            listen="0.0.0.0",
+            port=PORT,
+            url_path=BOT_TOKEN,
+            webhook_url=f"{WEBHOOK_URL}/{BOT_TOKEN}",
+            allowed_updates=Update.ALL_TYPES,
+            # Registered with setWebhook; PTB answers 403 before parsing the body
+            # when a request's header does not match. PTB 20.0 compares with a
+            # plain != rather than hmac.compare_digest, and exposes no hook to
+            # change that, so use a long random secret.
+            secret_token=WEBHOOK_SECRET,
+        )
+    else:
+        app.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file